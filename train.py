@@ -3,25 +3,30 @@
 # {jilin, songhan}@mit.edu
 
 import os
-import time
 import argparse
 import shutil
-import math
+import copy
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torchvision.transforms as transforms
+from torchvision.transforms import v2
 import torchvision.datasets as datasets
 import torch.optim as optim
+import torch.distributed as dist
 import numpy as np
 
 from tensorboardX import SummaryWriter
 
 from models.vgg import vgg16_bn, vgg16_bn_x
-from utils.utils import accuracy, AverageMeter, progress_bar
+from utils.utils import accuracy, Meters, CUDAPrefetcher, progress_bar
 from thop import profile
 
-from torch.utils.data import DataLoader, TensorDataset
+from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+from torch.utils.data import DataLoader, Subset, TensorDataset
+from torch.utils.data.distributed import DistributedSampler
 
 import pickle
 
@@ -31,9 +36,9 @@ def parse_args():
     parser.add_argument('--model', default='mobilenet', type=str, help='name of the model to train')
     parser.add_argument('--dataset', default='imagenet', type=str, help='name of the dataset to train')
     parser.add_argument('--lr', default=0.1, type=float, help='learning rate')
-    parser.add_argument('--n_gpu', default=1, type=int, help='number of GPUs to use')
-    parser.add_argument('--batch_size', default=32, type=int, help='batch size')
-    parser.add_argument('--n_worker', default=4, type=int, help='number of data loader worker')
+    parser.add_argument('--n_gpu', default=1, type=int, help='number of GPUs to use (launch with torchrun if > 1)')
+    parser.add_argument('--batch_size', default=32, type=int, help='batch size per GPU')
+    parser.add_argument('--n_worker', default=8, type=int, help='number of data loader worker')
     parser.add_argument('--lr_type', default='exp', type=str, help='lr scheduler (exp/cos/step3/fixed)')
     parser.add_argument('--n_epoch', default=150, type=int, help='number of epochs to train')
     parser.add_argument('--wd', default=4e-5, type=float, help='weight decay')
@@ -44,13 +49,21 @@ def parse_args():
     # run eval
     parser.add_argument('--eval', action='store_true', help='Simply run eval')
     parser.add_argument('--mixup', action='store_true', help='use mixup data augmentation')
+    parser.add_argument('--print_freq', default=50, type=int, help='batches between metric readbacks')
+    parser.add_argument('--log_freq', default=1, type=int, help='epochs between tensorboard writes')
     parser.add_argument('--prune_layer', nargs="+", default=None, help='layer to prune')
+    parser.add_argument('--compile', default=True, action=argparse.BooleanOptionalAction,
+                        help='wrap the model with torch.compile (reduce-overhead)')
+    parser.add_argument('--cuda_graph', action='store_true',
+                        help='capture the train forward/backward in CUDA graphs (single GPU, replaces --compile)')
+    parser.add_argument('--amp', default='bf16', type=str, help='autocast dtype (bf16/fp16/none)')
 
     return parser.parse_args()
 
 
 def get_model():
-    print('=> Building model..')
+    if rank == 0:
+        print('=> Building model..')
     if args.model == 'vgg16_bn':
         net = vgg16_bn()
     elif args.model == 'vgg16_bn_x':
@@ -59,18 +72,52 @@ def get_model():
         raise NotImplementedError
     return net.cuda() if use_cuda else net
 
-def mixup_data(x, y, alpha=0.086, use_cuda=True):
+def fuse_for_eval(model):
+    '''Folds every Conv2d -> BatchNorm2d pair of model.features into the conv, in place'''
+    model.eval()
+    features = model.features
+    for i in range(len(features) - 1):
+        if isinstance(features[i], nn.Conv2d) and isinstance(features[i + 1], nn.BatchNorm2d):
+            features[i] = fuse_conv_bn_eval(features[i], features[i + 1])
+            features[i + 1] = nn.Identity()
+    return model
+
+
+def log_scalar(tag, value, step):
+    '''Writes a tensorboard scalar from rank 0 only, every log_freq steps'''
+    if rank == 0 and step % args.log_freq == 0:
+        writer.add_scalar(tag, float(value), step)
+
+
+def unwrap_model(net):
+    '''Strips the torch.compile and DistributedDataParallel wrappers'''
+    model = getattr(net, '_orig_mod', net)
+    return model.module if isinstance(model, DDP) else model
+
+
+def random_crop(x, padding=4):
+    '''Zero-pads a NCHW batch and takes an independent random crop of the original size per image'''
+    n, _, h, w = x.shape
+    x = F.pad(x, (padding, padding, padding, padding))
+    dy = torch.randint(0, 2 * padding + 1, (n, 1, 1), device=x.device)
+    dx = torch.randint(0, 2 * padding + 1, (n, 1, 1), device=x.device)
+    rows = dy + torch.arange(h, device=x.device).view(1, h, 1)
+    cols = dx + torch.arange(w, device=x.device).view(1, 1, w)
+    batch = torch.arange(n, device=x.device).view(n, 1, 1)
+    # gather NHWC [n, h, w, c] and view it back as NCHW (channels_last in memory)
+    return x.permute(0, 2, 3, 1)[batch, rows, cols].permute(0, 3, 1, 2)
+
+
+def mixup_data(x, y, alpha=0.086):
     '''Returns mixed inputs, pairs of targets, and lambda'''
     if alpha > 0:
         lam = np.random.beta(alpha, alpha)
     else:
         lam = 1
     batch_size = x.size()[0]
-    if use_cuda:
-        index = torch.randperm(batch_size).cuda()
-    else:
-        index = torch.randperm(batch_size)
-    mixed_x = lam * x + (1 - lam) * x[index, :]
+    # permutation is generated on x's device, the shuffled rows are added in place
+    index = torch.randperm(batch_size, device=x.device)
+    mixed_x = x.mul(lam).add_(x.index_select(0, index), alpha=1 - lam)
     y_a, y_b = y, y[index]
     return mixed_x, y_a, y_b, lam
 
@@ -79,128 +126,229 @@ def mixup_criterion(criterion, pred, y_a, y_b, lam):
     return lam * criterion(pred, y_a) + (1 - lam) * criterion(pred, y_b)
 
 
+def capture_train_graph(model, image_shape):
+    '''Graphs the forward/backward of the model and the loss on a synthetic batch, returns the graphed callables'''
+    # make_graphed_callables captures in global mode, so this must run before any loader iterator
+    # (and its pin-memory thread) exists; hence a synthetic batch instead of the first real one
+    sample_inputs = torch.rand((args.batch_size,) + tuple(image_shape), device='cuda')
+    sample_inputs = sample_inputs.contiguous(memory_format=torch.channels_last)
+    sample_targets = torch.zeros(args.batch_size, dtype=torch.long, device='cuda')
+    out_dtype = amp_dtype if use_amp else torch.float32
+    sample_outputs = torch.randn(args.batch_size, model.classifier[-1].out_features,
+                                 dtype=out_dtype, device='cuda', requires_grad=True)
+    # the graphed module is patched in place, graph a copy of the loss so eval keeps the eager one
+    loss_fn = copy.deepcopy(criterion)
+    # warmup runs the synthetic batch in train mode, snapshot the BN statistics it would skew
+    bn_stats = {k: v.clone() for k, v in model.state_dict().items()
+                if k.endswith(('running_mean', 'running_var', 'num_batches_tracked'))}
+    with torch.autocast(device_type='cuda', dtype=amp_dtype, enabled=use_amp, cache_enabled=False):
+        graphed_model, graphed_loss = torch.cuda.make_graphed_callables(
+            (model, loss_fn), ((sample_inputs,), (sample_outputs, sample_targets)))
+    # restore in place, the captured kernels keep pointing at the same buffers
+    state_dict = model.state_dict()
+    with torch.no_grad():
+        for k, v in bn_stats.items():
+            state_dict[k].copy_(v)
+    return graphed_model, graphed_loss
+
+
 def train(epoch, train_loader):
-    print('\nEpoch: %d' % epoch)
+    global train_graph
+    if rank == 0:
+        print('\nEpoch: %d' % epoch)
     net.train()
-
-    batch_time = AverageMeter()
-    losses = AverageMeter()
-    top1 = AverageMeter()
-    top5 = AverageMeter()
-    end = time.time()
-    for batch_idx, (inputs, targets) in enumerate(train_loader):
-        optimizer.zero_grad()
-        if use_cuda:
-            inputs, targets = inputs.cuda(), targets.cuda()
-        if not args.mixup:
-            outputs = net(inputs)
-            loss = criterion(outputs, targets)
-        else:
-            inputs, targets_a, targets_b, lam = mixup_data(inputs, targets, use_cuda=use_cuda)
-            outputs = net(inputs)
-            loss = mixup_criterion(criterion, outputs, targets_a, targets_b, lam)
-
-        loss.backward()
-        optimizer.step()
+    # a varying mixup lambda can not be baked into the graph, so mixup stays eager
+    use_graph = args.cuda_graph and use_cuda and not args.mixup and not distributed
+
+    # running sums stay on the device, read back every print_freq batches
+    if use_graph and train_graph is None:
+        train_graph = capture_train_graph(net, train_loader.dataset.tensors[0].shape[1:])
+
+    meters = Meters(device)
+    msg = None
+    # the prefetcher already hands out GPU tensors, copied on a side stream
+    batches = CUDAPrefetcher(train_loader) if use_cuda else train_loader
+    for batch_idx, (inputs, targets) in enumerate(batches):
+        optimizer.zero_grad(set_to_none=True)
+        inputs = train_transforms(random_crop(inputs)).contiguous(memory_format=torch.channels_last)
+        if args.mixup:
+            inputs, targets_a, targets_b, lam = mixup_data(inputs, targets)
+        model, loss_fn = train_graph if use_graph else (net, criterion)
+        with torch.autocast(device_type='cuda', dtype=amp_dtype, enabled=use_amp, cache_enabled=not use_graph):
+            outputs = model(inputs)
+            if not args.mixup:
+                loss = loss_fn(outputs, targets)
+            else:
+                # a tensor lam keeps the compiled criterion from specializing on every new value
+                loss = mixup_loss_fn(criterion, outputs, targets_a, targets_b, torch.tensor(lam, dtype=torch.float32))
+
+        # scaler is a pass-through unless training in fp16
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
 
         # measure accuracy and record loss
-        prec1, prec5 = accuracy(outputs.data, targets.data, topk=(1, 5))
-        losses.update(loss.item(), inputs.size(0))
-        if not args.mixup:
-            top1.update(prec1.item(), inputs.size(0))
-        else:
-            _, predicted = torch.max(outputs.data, 1)
-            prec1 = (lam * predicted.eq(targets_a.data).cpu().sum().float()
-                     + (1 - lam) * predicted.eq(targets_b.data).cpu().sum().float())
-            prec1 = prec1 * 100 / inputs.size(0)
-            top1.update(prec1, inputs.size(0))
-
-        top5.update(prec5.item(), inputs.size(0))
-        # timing
-        batch_time.update(time.time() - end)
-        end = time.time()
-
-        progress_bar(batch_idx, len(train_loader), 'Loss: {:.3f} | Acc1: {:.3f}% | Acc5: {:.3f}%'
-                     .format(losses.avg, top1.avg, top5.avg))
+        n = inputs.size(0)
+        prec1, prec5 = accuracy_fn(outputs.detach(), targets, topk=(1, 5))
+        if args.mixup:
+            _, predicted = torch.max(outputs.detach(), 1)
+            prec1 = (lam * predicted.eq(targets_a).sum() + (1 - lam) * predicted.eq(targets_b).sum()) * 100. / n
+        meters.update(loss.detach(), prec1, prec5, n)
+
+        if rank == 0:
+            if batch_idx % args.print_freq == 0:
+                msg = 'Loss: {:.3f} | Acc1: {:.3f}% | Acc5: {:.3f}%'.format(*meters.average())
+            progress_bar(batch_idx, len(train_loader), msg)
         # disp_mask(net, args.prune_layer)
-    writer.add_scalar('loss/train', losses.avg, epoch)
-    writer.add_scalar('acc/train_top1', top1.avg, epoch)
-    writer.add_scalar('acc/train_top5', top5.avg, epoch)
+    loss_avg, top1_avg, top5_avg = meters.average(all_reduce=distributed)
+    if rank == 0:
+        print('Loss: {:.3f} | Acc1: {:.3f}% | Acc5: {:.3f}%'.format(loss_avg, top1_avg, top5_avg))
+    log_scalar('loss/train', loss_avg, epoch)
+    log_scalar('acc/train_top1', top1_avg, epoch)
+    log_scalar('acc/train_top5', top5_avg, epoch)
+
+
+def capture_eval_graph(model, sample_inputs, sample_targets):
+    '''Captures the eval forward + loss into a CUDA graph, returns it with its static buffers'''
+    static_in = sample_inputs.clone()
+    static_tgt = sample_targets.clone()
+    # warm up on a side stream so cudnn autotuning and allocations happen outside the capture
+    s = torch.cuda.Stream()
+    s.wait_stream(torch.cuda.current_stream())
+    with torch.cuda.stream(s):
+        for _ in range(3):
+            with torch.autocast(device_type='cuda', dtype=amp_dtype, enabled=use_amp, cache_enabled=False):
+                criterion(model(static_in), static_tgt)
+    torch.cuda.current_stream().wait_stream(s)
+
+    graph = torch.cuda.CUDAGraph()
+    # thread_local: the loader's pin-memory thread keeps using the CUDA host allocator during capture
+    with torch.cuda.graph(graph, capture_error_mode='thread_local'):
+        with torch.autocast(device_type='cuda', dtype=amp_dtype, enabled=use_amp, cache_enabled=False):
+            static_out = model(static_in)
+            static_loss = criterion(static_out, static_tgt)
+    return graph, static_in, static_tgt, static_out, static_loss
 
 
 def test(epoch, test_loader, save=True):
-    global best_acc
+    global best_acc, eval_graph
     net.eval()
+    # replay a captured graph of the bare model, eval needs neither compile nor DDP
+    model = unwrap_model(net)
+    use_graph = use_cuda
 
-    batch_time = AverageMeter()
-    losses = AverageMeter()
-    top1 = AverageMeter()
-    top5 = AverageMeter()
-    end = time.time()
+    meters = Meters(device)
+    msg = None
 
     with torch.no_grad():
-        for batch_idx, (inputs, targets) in enumerate(test_loader):
-            if use_cuda:
-                inputs, targets = inputs.cuda(), targets.cuda()
-            outputs = net(inputs)
-            loss = criterion(outputs, targets)
+        batches = CUDAPrefetcher(test_loader) if use_cuda else test_loader
+        for batch_idx, (inputs, targets) in enumerate(batches):
+            inputs = test_transforms(inputs).contiguous(memory_format=torch.channels_last)
+            if use_graph and inputs.size(0) == args.batch_size:
+                if eval_graph is None:
+                    eval_graph = capture_eval_graph(model, inputs, targets)
+                graph, static_in, static_tgt, static_out, static_loss = eval_graph
+                static_in.copy_(inputs, non_blocking=True)
+                static_tgt.copy_(targets, non_blocking=True)
+                graph.replay()
+                outputs, loss = static_out, static_loss
+            else:  # last partial batch
+                with torch.autocast(device_type='cuda', dtype=amp_dtype, enabled=use_amp):
+                    outputs = model(inputs)
+                    loss = criterion(outputs, targets)
 
             # measure accuracy and record loss
-            prec1, prec5 = accuracy(outputs.data, targets.data, topk=(1, 5))
-            losses.update(loss.item(), inputs.size(0))
-            top1.update(prec1.item(), inputs.size(0))
-            top5.update(prec5.item(), inputs.size(0))
-            # timing
-            batch_time.update(time.time() - end)
-            end = time.time()
+            n = inputs.size(0)
+            prec1, prec5 = accuracy_fn(outputs, targets, topk=(1, 5))
+            meters.update(loss, prec1, prec5, n)
 
-            progress_bar(batch_idx, len(test_loader), 'Loss: {:.3f} | Acc1: {:.3f}% | Acc5: {:.3f}%'
-                         .format(losses.avg, top1.avg, top5.avg))
+            if rank == 0:
+                if batch_idx % args.print_freq == 0:
+                    msg = 'Loss: {:.3f} | Acc1: {:.3f}% | Acc5: {:.3f}%'.format(*meters.average())
+                progress_bar(batch_idx, len(test_loader), msg)
 
-    if save:
-        writer.add_scalar('loss/test', losses.avg, epoch)
-        writer.add_scalar('acc/test_top1', top1.avg, epoch)
-        writer.add_scalar('acc/test_top5', top5.avg, epoch)
+    loss_avg, top1_avg, top5_avg = meters.average(all_reduce=distributed)
+    if rank == 0:
+        print('Loss: {:.3f} | Acc1: {:.3f}% | Acc5: {:.3f}%'.format(loss_avg, top1_avg, top5_avg))
+
+    # every rank sees the same reduced metrics, so best_acc stays in sync without a broadcast
+    is_best = False
+    if save and top1_avg > best_acc:
+        best_acc = top1_avg
+        is_best = True
 
-        is_best = False
-        if top1.avg > best_acc:
-            best_acc = top1.avg
-            is_best = True
+    if save:
+        log_scalar('loss/test', loss_avg, epoch)
+        log_scalar('acc/test_top1', top1_avg, epoch)
+        log_scalar('acc/test_top5', top5_avg, epoch)
 
+    if save and rank == 0:
         print('Current best acc: {}'.format(best_acc))
         save_checkpoint({
             'epoch': epoch,
             'model': args.model,
             'dataset': args.dataset,
-            'state_dict': net.module.state_dict() if isinstance(net, nn.DataParallel) else net.state_dict(),
-            'acc': top1.avg,
+            'state_dict': model.state_dict(),
+            'acc': top1_avg,
             'optimizer': optimizer.state_dict(),
         }, is_best, checkpoint_dir=log_dir)
 
 
-def adjust_learning_rate(optimizer, epoch):
+def get_lr_scheduler(optimizer):
     if args.lr_type == 'cos':  # cos without warm-up
-        lr = 0.5 * args.lr * (1 + math.cos(math.pi * epoch / args.n_epoch))
+        return optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=args.n_epoch)
     elif args.lr_type == 'exp':
-        step = 1
-        decay = 0.96
-        lr = args.lr * (decay ** (epoch // step))
+        return optim.lr_scheduler.ExponentialLR(optimizer, gamma=0.96)
     elif args.lr_type == 'fixed':
-        lr = args.lr
+        return optim.lr_scheduler.LambdaLR(optimizer, lambda epoch: 1.0)
     else:
         raise NotImplementedError
-    print('=> lr: {}'.format(lr))
-    for param_group in optimizer.param_groups:
-        param_group['lr'] = lr
-    return lr
 
 
 def save_checkpoint(state, is_best, checkpoint_dir='.'):
     filename = os.path.join(checkpoint_dir, 'ckpt.pth.tar')
     print('=> Saving checkpoint to {}'.format(filename))
-    torch.save(state, filename)
+    # write a fresh inode and rename it over, the best checkpoint may be a hardlink to the old one
+    tmp_filename = filename + '.tmp'
+    torch.save(state, tmp_filename, pickle_protocol=4)
+    os.replace(tmp_filename, filename)
     if is_best:
-        shutil.copyfile(filename, filename.replace('.pth.tar', '.best.pth.tar'))
+        best_filename = filename.replace('.pth.tar', '.best.pth.tar')
+        # link under a temp name and rename over the old best, so there is always a best checkpoint
+        tmp_best = best_filename + '.tmp'
+        if os.path.exists(tmp_best):
+            os.remove(tmp_best)
+        try:
+            os.link(filename, tmp_best)
+        except OSError:  # filesystem without hardlink support
+            shutil.copyfile(filename, tmp_best)
+        os.replace(tmp_best, best_filename)
+
+def load_tensor(name, image=False):
+    '''Loads ../<name>.pkl as a tensor, cached to ../<name>.pt so later runs only mmap it'''
+    pkl_path = '../{}.pkl'.format(name)
+    cache_path = '../{}.pt'.format(name)
+    # rebuild when the pickle was regenerated after the cache was written; only rank 0 converts
+    stale = not os.path.exists(cache_path) or (os.path.exists(pkl_path)
+                                               and os.path.getmtime(pkl_path) > os.path.getmtime(cache_path))
+    if rank == 0 and stale:
+        print('=> Converting {} to {}'.format(pkl_path, cache_path))
+        with open(pkl_path, 'rb') as f:
+            array = pickle.load(f)
+        # from_numpy shares the pickled buffer, only the layout/dtype changes below copy
+        tensor = torch.from_numpy(np.ascontiguousarray(array))
+        if image:  # NHWC -> uint8 NCHW, the device-side transforms cast and augment
+            tensor = tensor.to(torch.uint8).permute(0, 3, 1, 2).contiguous()
+        else:  # class indices for CrossEntropyLoss
+            tensor = tensor.long()
+        # write then rename, so an interrupted conversion never leaves a partial cache behind
+        tmp_path = cache_path + '.tmp'
+        torch.save(tensor, tmp_path)
+        os.replace(tmp_path, cache_path)
+    if distributed:  # the other ranks wait for rank 0 to finish writing the cache
+        dist.barrier()
+    return torch.load(cache_path, mmap=True)
+
 
 def get_output_folder(parent_dir, env_name):
     """Return save folder.
@@ -239,12 +387,26 @@ def get_output_folder(parent_dir, env_name):
 if __name__ == '__main__':
     args = parse_args()
 
+    # torchrun sets WORLD_SIZE/RANK/LOCAL_RANK, one process per GPU
+    distributed = int(os.environ.get('WORLD_SIZE', 1)) > 1
+    if distributed:
+        dist.init_process_group('nccl')
+        rank = dist.get_rank()
+        local_rank = int(os.environ['LOCAL_RANK'])
+        torch.cuda.set_device(local_rank)
+    elif args.n_gpu > 1:
+        raise ValueError('Please launch with torchrun --nproc_per_node={} for multi-GPU training'.format(args.n_gpu))
+    else:
+        rank = 0
+
     use_cuda = torch.cuda.is_available()
     if use_cuda:
         torch.backends.cudnn.benchmark = True
     device = 'cuda' if use_cuda else 'cpu'
 
     best_acc = 0  # best test accuracy
+    eval_graph = None  # captured lazily on the first full eval batch
+    train_graph = None  # captured at the start of the first epoch with --cuda_graph
     start_epoch = 0  # start from epoch 0 or last checkpoint epoch
 
     if args.seed is not None:
@@ -252,7 +414,8 @@ if __name__ == '__main__':
         torch.manual_seed(args.seed)
         torch.cuda.manual_seed(args.seed)
 
-    print('=> Preparing data..')
+    if rank == 0:
+        print('=> Preparing data..')
     # get dir
     # traindir = os.path.join(args.data_root, 'train')
     # valdir = os.path.join(args.data_root, 'val')
@@ -282,28 +445,29 @@ if __name__ == '__main__':
     #     batch_size=args.batch_size, shuffle=False,
     #     num_workers=args.n_worker, pin_memory=True)
 
-    train_images = pickle.load(open('../train_images.pkl', 'rb'))
-    train_labels = pickle.load(open('../train_labels.pkl', 'rb'))
-    val_images = pickle.load(open('../val_images.pkl', 'rb'))
-    val_labels = pickle.load(open('../val_labels.pkl', 'rb'))
+    train_images = load_tensor('train_images', image=True)
+    train_labels = load_tensor('train_labels')
+    val_images = load_tensor('val_images', image=True)
+    val_labels = load_tensor('val_labels')
 
-    print("Type of val_images:", type(val_images))
-    print("Type of val_labels:", type(val_labels))
+    if rank == 0:
+        print("Type of val_images:", type(val_images))
+        print("Type of val_labels:", type(val_labels))
 
-    # Check the shape of val_images and val_labels
-    print("Shape of val_images:", val_images.shape)
-    print("Shape of val_labels:", val_labels.shape)
+        # Check the shape of val_images and val_labels
+        print("Shape of val_images:", val_images.shape)
+        print("Shape of val_labels:", val_labels.shape)
 
-    # Check the data type of val_images and val_labels
-    print("Data type of val_images:", val_images.dtype)
-    print("Data type of val_labels:", val_labels.dtype)
+        # Check the data type of val_images and val_labels
+        print("Data type of val_images:", val_images.dtype)
+        print("Data type of val_labels:", val_labels.dtype)
 
-    # Check the range of values in val_images
-    print("Minimum value in val_images:", val_images.min())
-    print("Maximum value in val_images:", val_images.max())
+        # Check the range of values in val_images
+        print("Minimum value in val_images:", val_images.min())
+        print("Maximum value in val_images:", val_images.max())
 
-    # Check the unique labels in val_labels
-    print("Unique labels in val_labels:", np.unique(val_labels))
+        # Check the unique labels in val_labels
+        print("Unique labels in val_labels:", torch.unique(val_labels))
 
     # Define the transformations for your dataset
     # train_transforms = transforms.Compose([
@@ -325,79 +489,131 @@ if __name__ == '__main__':
     # ])
 
 
-    train_transforms = transforms.Compose([
-        transforms.ToPILImage(),
-        transforms.Pad(4),
-        transforms.RandomCrop(32),
-        transforms.ToTensor()
+    # augmentation runs on-device per batch, so keep the raw images as uint8 NCHW tensors;
+    # the Pad(4) + RandomCrop(32) offsets are drawn per image in random_crop, v2 would share one per batch
+    train_transforms = v2.Compose([
+        v2.ToDtype(torch.float32, scale=True),
     ])
 
-    test_transforms = transforms.Compose([
-        transforms.ToPILImage(),
-        transforms.Pad(4),
-        transforms.RandomCrop(32),
-        transforms.ToTensor()
+    # Pad(4) + centered 32 crop is the identity, so eval only needs the dtype cast
+    test_transforms = v2.Compose([
+        v2.ToDtype(torch.float32, scale=True),
     ])
 
-    # Apply transformations to the data
-    train_images_tensor = torch.stack([train_transforms(image) for image in train_images])
-    train_labels_tensor = torch.from_numpy(train_labels)
-    val_images_tensor = torch.stack([test_transforms(image) for image in val_images])
-    val_labels_tensor = torch.from_numpy(val_labels)
-
-    print("Applied Transformations.")
-
     # Create TensorDataset instances
-    train_dataset = TensorDataset(train_images_tensor, train_labels_tensor)
-    val_dataset = TensorDataset(val_images_tensor, val_labels_tensor)
+    train_dataset = TensorDataset(train_images, train_labels)
+    val_dataset = TensorDataset(val_images, val_labels)
 
     # Create DataLoaders
-    train_loader = DataLoader(train_dataset, batch_size=args.batch_size, shuffle=True, num_workers=args.n_worker, pin_memory=True)
-    val_loader = DataLoader(val_dataset, batch_size=args.batch_size, shuffle=False, num_workers=args.n_worker, pin_memory=True)
-
-    print("Created Datasets and Dataloaders.")
-
-    net = get_model()  # for measure
-    IMAGE_SIZE = 224 if args.dataset == 'imagenet' else 32
-    dummy = torch.rand((1, 3, IMAGE_SIZE, IMAGE_SIZE)).to(device)
-    n_flops, n_params = profile(net, (dummy, ), verbose=False)
-    print('=> Model Parameter: {:.3f} M, FLOPs: {:.3f}M'.format(n_params / 1e6, n_flops / 1e6))
-    del net
+    # keep workers alive across epochs and queue a deeper prefetch per worker
+    loader_kwargs = dict(num_workers=args.n_worker, pin_memory=True)
+    if args.n_worker > 0:
+        loader_kwargs.update(persistent_workers=True, prefetch_factor=4)
+    # each rank gets its own shard; val shards are summed back by Meters.average
+    train_sampler = DistributedSampler(train_dataset, shuffle=True, drop_last=True) if distributed else None
+    # strided val shards of uneven size instead of DistributedSampler, whose padding would count
+    # repeated samples and make val accuracy differ from a single-GPU run
+    if distributed:
+        val_dataset = Subset(val_dataset, range(rank, len(val_dataset), dist.get_world_size()))
+    # drop_last keeps the train batch shape static so the compiled graph is not re-captured
+    train_loader = DataLoader(train_dataset, batch_size=args.batch_size, shuffle=train_sampler is None,
+                              sampler=train_sampler, drop_last=True, **loader_kwargs)
+    val_loader = DataLoader(val_dataset, batch_size=args.batch_size, shuffle=False, **loader_kwargs)
+
+    if rank == 0:
+        print("Created Datasets and Dataloaders.")
 
     net = get_model()
 
     if args.ckpt_path is not None:  # assigned checkpoint path to resume from
-        print('=> Resuming from checkpoint..')
-        checkpoint = torch.load(args.ckpt_path)
+        if rank == 0:
+            print('=> Resuming from checkpoint..')
+        # load on the CPU so torchrun ranks do not all land on the device the checkpoint was saved from
+        checkpoint = torch.load(args.ckpt_path, map_location='cpu')
         sd = checkpoint['state_dict'] if 'state_dict' in checkpoint else checkpoint
         net.load_state_dict(sd)
 
-    if use_cuda and args.n_gpu > 1:
-        net = torch.nn.DataParallel(net, list(range(args.n_gpu)))
+    IMAGE_SIZE = 224 if args.dataset == 'imagenet' else 32
+    dummy = torch.rand((1, 3, IMAGE_SIZE, IMAGE_SIZE)).to(device)
+    n_flops, n_params = profile(net, (dummy, ), verbose=False)
+    # thop leaves total_ops/total_params buffers on container modules, keep them out of the state_dict
+    for m in net.modules():
+        m._buffers.pop('total_ops', None)
+        m._buffers.pop('total_params', None)
+    if rank == 0:
+        print('=> Model Parameter: {:.3f} M, FLOPs: {:.3f}M'.format(n_params / 1e6, n_flops / 1e6))
+
+    if args.eval:  # BN is a fixed affine at eval time, never fuse a model that will be trained
+        if rank == 0:
+            print('=> Fusing Conv+BN for evaluation..')
+        net = fuse_for_eval(net)
+
+    # NHWC lets cudnn pick tensor-core conv kernels without layout transposes; set before compile/capture
+    net = net.to(memory_format=torch.channels_last)
+
+    if distributed:
+        net = DDP(net, device_ids=[local_rank], bucket_cap_mb=25, gradient_as_bucket_view=True)
     elif use_cuda:
         net.cuda()
 
+    if use_cuda and args.compile and not args.cuda_graph:
+        if rank == 0:
+            print('=> Compiling model..')
+        net = torch.compile(net, mode='reduce-overhead', fullgraph=False)
+        # the small per-batch helpers each fuse into a single kernel
+        accuracy_fn = torch.compile(accuracy, dynamic=False)
+        mixup_loss_fn = torch.compile(mixup_criterion, dynamic=False)
+    else:
+        accuracy_fn, mixup_loss_fn = accuracy, mixup_criterion
+
     criterion = nn.CrossEntropyLoss()
-    print('Using SGD...')
-    print('weight decay  = {}'.format(args.wd))
-    optimizer = optim.SGD(net.parameters(), lr=args.lr, momentum=0.9, weight_decay=args.wd)
+    if rank == 0:
+        print('Using SGD...')
+        print('weight decay  = {}'.format(args.wd))
+    # fused takes precedence over foreach (they are mutually exclusive); CPU keeps the default path
+    optimizer = optim.SGD(net.parameters(), lr=args.lr, momentum=0.9, weight_decay=args.wd, fused=use_cuda)
+    scheduler = get_lr_scheduler(optimizer)
+
+    if args.amp == 'bf16':
+        amp_dtype = torch.bfloat16
+    elif args.amp == 'fp16':
+        amp_dtype = torch.float16
+    elif args.amp == 'none':
+        amp_dtype = None
+    else:
+        raise NotImplementedError
+    use_amp = use_cuda and amp_dtype is not None
+    if rank == 0:
+        print('=> Mixed precision: {}'.format(args.amp if use_amp else 'none'))
+    # bf16 has fp32's exponent range, only fp16 needs loss scaling
+    scaler = torch.amp.GradScaler('cuda', enabled=use_amp and amp_dtype == torch.float16)
 
     if args.eval:  # just run eval
-        print('=> Start evaluation...')
+        if rank == 0:
+            print('=> Start evaluation...')
         test(0, val_loader, save=False)
     else:  # train
-        print('=> Start training...')
-        print('Training {} on {}...'.format(args.model, args.dataset))
-        log_dir = get_output_folder('./logs', '{}_{}_finetune'.format(args.model, args.dataset))
-        print('=> Saving logs to {}'.format(log_dir))
-        # tf writer
-        writer = SummaryWriter(logdir=log_dir)
+        if rank == 0:
+            print('=> Start training...')
+            print('Training {} on {}...'.format(args.model, args.dataset))
+            log_dir = get_output_folder('./logs', '{}_{}_finetune'.format(args.model, args.dataset))
+            print('=> Saving logs to {}'.format(log_dir))
+            # tf writer, only rank 0 writes (see log_scalar)
+            writer = SummaryWriter(logdir=log_dir)
 
         for epoch in range(start_epoch, start_epoch + args.n_epoch):
-            lr = adjust_learning_rate(optimizer, epoch)
+            if distributed:
+                train_sampler.set_epoch(epoch)
+            if rank == 0:
+                print('=> lr: {}'.format(scheduler.get_last_lr()[0]))
             train(epoch, train_loader)
             test(epoch, val_loader)
+            scheduler.step()
+
+        if rank == 0:
+            writer.close()
+            print('=> Model Parameter: {:.3f} M, FLOPs: {:.3f}M, best top-1 acc: {}%'.format(n_params / 1e6,
+                                                                                             n_flops / 1e6, best_acc))
 
-        writer.close()
-        print('=> Model Parameter: {:.3f} M, FLOPs: {:.3f}M, best top-1 acc: {}%'.format(n_params / 1e6,
-                                                                                         n_flops / 1e6, best_acc))
+    if distributed:
+        dist.destroy_process_group()
@@ -4,6 +4,7 @@
 
 import os
 import torch
+import torch.distributed
 import time
 import sys
 
@@ -33,6 +34,61 @@ class AverageMeter(object):
             self.avg = self.sum / self.count
 
 
+class Meters(object):
+    """Sums loss/top1/top5 in one device tensor, only synced when the averages are read"""
+    def __init__(self, device):
+        self.sums = torch.zeros(3, device=device)
+        self.count = 0
+
+    def update(self, loss, prec1, prec5, n=1):
+        self.sums += torch.stack([loss, prec1, prec5]) * n
+        self.count += n
+
+    def average(self, all_reduce=False):
+        totals = torch.cat([self.sums, self.sums.new_tensor([self.count])])
+        if all_reduce:
+            torch.distributed.all_reduce(totals)
+        return (totals[:3] / totals[3]).tolist()
+
+
+class CUDAPrefetcher(object):
+    """Copies the next batch to the GPU on a side stream while the current one is computed"""
+    def __init__(self, loader):
+        self.loader = iter(loader)
+        self.stream = torch.cuda.Stream()
+        self._preload()
+
+    def _preload(self):
+        try:
+            next_input, next_target = next(self.loader)
+        except StopIteration:
+            self.next_input = None
+            self.next_target = None
+            return
+        with torch.cuda.stream(self.stream):
+            self.next_input = next_input.cuda(non_blocking=True)
+            self.next_target = next_target.cuda(non_blocking=True)
+
+    def next(self):
+        torch.cuda.current_stream().wait_stream(self.stream)
+        inputs, targets = self.next_input, self.next_target
+        if inputs is not None:
+            # allocated on the side stream, keep the allocator from reusing them too early
+            inputs.record_stream(torch.cuda.current_stream())
+            targets.record_stream(torch.cuda.current_stream())
+            self._preload()
+        return inputs, targets
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        inputs, targets = self.next()
+        if inputs is None:
+            raise StopIteration
+        return inputs, targets
+
+
 class TextLogger(object):
     """Write log immediately to the disk"""
     def __init__(self, filepath):
@@ -60,31 +116,19 @@ def accuracy(output, target, topk=(1,)):
     """Computes the precision@k for the specified values of k"""
     # ouput is [batch, 1000]
     # target is [batch]
-    batch_size = target.size(0)
     num = output.size(1)
-    target_topk = []
-    appendices = []
-    for k in topk:
-        if k <= num:
-            target_topk.append(k)
-        else:
-            appendices.append([0.0])
-    topk = target_topk
-    maxk = max(topk)
-    # k=maxk dim=1
-    _, pred = output.topk(maxk, 1, True, True)
-    # pred size is [100, 5]
-    # transpose
-    pred = pred.t()
-    # pred size is [5,100]
-    correct = pred.eq(target.view(1, -1).expand_as(pred))
-    # correct is true/false
+    maxk = min(max(topk), num)
+    pred = output.topk(maxk, 1).indices
+    # correct is [batch, maxk] true/false, at most one hit per row
+    correct = pred.eq(target.unsqueeze(1))
 
     res = []
     for k in topk:
-        correct_k = correct[:k].contiguous().view(-1).float().sum(0)
-        res.append(correct_k.mul_(100.0 / batch_size))
-    return res + appendices
+        if k <= num:
+            res.append(correct[:, :k].any(dim=1).float().mean() * 100.0)
+        else:
+            res.append([0.0])
+    return res
 
 
 # Custom progress bar